@@ -2,107 +2,244 @@
 # Date: 11/7/2023
 # For: SWE Intern Take-Home
 
+import os
+import time
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 import csv
-from datetime import datetime, timedelta, date
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from bisect import bisect_left
+from datetime import timedelta, date
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
 
 STYLE = 'classical'
 BASE_URL = "https://lichess.org/api"
 DATE_FORMAT = '%Y-%m-%d'
 DAYS_BACK = 31
+NO_RATING = "No rating found" # shown for days before a player's first classical rating
+TIMEOUT = (3.05, 10) # (connect, read) seconds
+MAX_RETRIES = 3 # retries for rate limited (429) or unavailable (502/503) responses
+RETRY_STATUSES = (429, 502, 503)
+CSV_DEADLINE = 60 # seconds to wait for rating histories beyond the rate limiter's schedule
 
-today = datetime.today().date()
-dates = [(today - timedelta(days=i)).strftime(DATE_FORMAT) for i in range(DAYS_BACK)][::-1]
+# An API token raises Lichess's anonymous rate limit of ~15 requests/min to ~60 requests/min
+LICHESS_TOKEN = os.environ.get('LICHESS_TOKEN')
+RATE_LIMIT = 60 if LICHESS_TOKEN else 15 # requests per minute
+# A full rate limiter bucket lets RATE_LIMIT requests through at once; any more workers would only
+# sleep in the limiter, so use one worker (and one pooled connection) per token
+MAX_WORKERS = RATE_LIMIT
 
+# Shared session so every request reuses pooled keep-alive connections to lichess.org
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=MAX_WORKERS,
+    # urllib3 only retries connection failures; retries of rate limited or unavailable responses
+    # go through _get so they take a token from the rate limiter like any other request
+    max_retries=Retry(total=MAX_RETRIES, backoff_factor=0.5, backoff_jitter=0.5),
+))
 
-def fetch_top_classical_players(n=50) -> list:
+if LICHESS_TOKEN:
+    SESSION.headers['Authorization'] = f'Bearer {LICHESS_TOKEN}'
+
+
+class RateLimiter:
     """
-    Fetches the top N classical chess players
+    Token bucket allowing `rate` requests every `per` seconds, shared across threads.
+    Use as a context manager around each request, or call acquire() to give up at a deadline.
     """
-    players = []
-    try:
-        resp = requests.get(f'{BASE_URL}/player/top/{n}/{STYLE}')
-        resp.raise_for_status()
-        data = resp.json()
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self, deadline=None) -> bool:
+        """
+        Takes a token, sleeping until the bucket has refilled enough if it is empty.
+        Returns False without taking a token if that would mean sleeping past `deadline` (a time.monotonic() value).
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+            self._updated = now
+            delay = (1 - self._tokens) * self.per / self.rate
+            if deadline is not None and now + delay > deadline:
+                return False
+            # Reserve a token now; if the bucket is empty, wait until it refills
+            self._tokens -= 1
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+RATE_LIMITER = RateLimiter(rate=RATE_LIMIT, per=60)
+
+# The 30-day window is fixed once at startup so every player is reported against the same days.
+# A run that crosses midnight will therefore report the window as of when it started.
+TODAY = date.today()
+TODAY_ORD = TODAY.toordinal()
+DATES = tuple((TODAY - timedelta(days=i)).strftime(DATE_FORMAT) for i in range(DAYS_BACK - 1, -1, -1))
+
+
+def _get(url, deadline=None) -> requests.Response:
+    """
+    Sends a GET request through the shared session, waiting for the rate limiter before every attempt.
+    Rate limited or unavailable responses are retried up to MAX_RETRIES times, honouring Retry-After,
+    and the last response is returned once retries run out so callers handle it through resp.ok.
+    With a `deadline` (a time.monotonic() value), returns None rather than waiting past it to send a request,
+    and stops retrying once the next attempt would start after it.
+    """
+    resp = None
+    for attempt in range(MAX_RETRIES + 1):
+        if not RATE_LIMITER.acquire(deadline):
+            return resp
+        resp = SESSION.get(url, timeout=TIMEOUT)
+        if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return resp
+        retry_after = resp.headers.get('Retry-After', '')
+        delay = int(retry_after) if retry_after.isdigit() else 0.5 * 2 ** attempt
+        if deadline is not None and time.monotonic() + delay > deadline:
+            return resp
+        time.sleep(delay)
 
-        if 'users' in data:
-            players = data['users'][:n]
-        else:
-            print("Error: The response JSON does not contain the 'users' key.")
 
+# Leaderboards already fetched this run, by N
+_TOP_PLAYERS_CACHE = {}
+
+
+def fetch_top_classical_players(n=50) -> list:
+    """
+    Fetches the top N classical chess players, cached so the leaderboard is only requested once per run
+    """
+    if n in _TOP_PLAYERS_CACHE:
+        return list(_TOP_PLAYERS_CACHE[n])
+
+    try:
+        resp = _get(f'{BASE_URL}/player/top/{n}/{STYLE}')
     except RequestException as e:
         print(f"An error occurred while making the request: {e}")
-    except ValueError:
+        return []
+    if not resp.ok:
+        print(f"Error: The request for the top {n} players failed with status {resp.status_code}.")
+        return []
+
+    try:
+        data = orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
         print("Error: Failed to parse JSON response.")
-    
-    return players
+        return []
+    if 'users' not in data:
+        print("Error: The response JSON does not contain the 'users' key.")
+        return []
+
+    # Only successful responses are cached, so a failed request is retried next time
+    _TOP_PLAYERS_CACHE[n] = data['users'][:n]
+    return list(_TOP_PLAYERS_CACHE[n])
 
 # Warmup: List the top 50 classical chess players. Just print their usernames.
 def print_top_50_classical_players() -> None:
-    players = fetch_top_classical_players()
+    players = fetch_top_classical_players(50)
     for player in players:
         print(player['username'])
     
 
-def fetch_last_30_day_rating_for_player(username) -> dict:
+# Classical rating points already fetched this run, by username
+_HISTORY_CACHE = {}
+
+
+def _fetch_classical_rating_points(username, deadline=None) -> list:
     """
-    Fetches the rating history for the top classical chess player for the last 30 days 
-    and returns a dict in format: {username: {today-29: 990, today-28: 991, etc}}
+    Fetches a player's classical rating history as [year, month, day, rating] points sorted by date,
+    cached so each player's history is only requested once per run.
+    Returns None if the player has no classical history, or without caching if Lichess responds with an error
+    or the request couldn't be sent before `deadline`.
+    """
+    if username in _HISTORY_CACHE:
+        return _HISTORY_CACHE[username]
+
+    resp = _get(f'{BASE_URL}/user/{username}/rating-history', deadline)
+    if resp is None:
+        print(f"Error: Skipped the rating history request for {username} because the deadline passed.")
+        return None
+    if not resp.ok:
+        print(f"Error: The rating history request for {username} failed with status {resp.status_code}.")
+        return None
+    data = orjson.loads(resp.content)
+
+    # Filter the rating history by desired chess style, in this case Classical
+    classical_history = next((category for category in data if category['name'] == STYLE.capitalize()), None)
+    points = sorted(classical_history['points'], key=lambda point: point[:3]) if classical_history else None
+
+    _HISTORY_CACHE[username] = points
+    return points
+
+
+def fetch_daily_ratings_for_player(username, deadline=None) -> list:
+    """
+    Fetches the classical rating history for a player for the last 30 days
+    and returns a list of ratings lined up with DATES: [990, 991, etc].
+    Days before the player's first rating are None, and the list is empty if there is no classical history
+    or it couldn't be requested before `deadline` (a time.monotonic() value).
     """
     try:
-        resp = requests.get(f'{BASE_URL}/user/{username}/rating-history')
-        resp.raise_for_status()
-        data = resp.json()
-
-        # Filter the rating history by desired chess style, in this case Classical
-        classical_history = next((category for category in data if category['name'] == STYLE.capitalize()), None)
-        if not classical_history:
-            return {}
-        
-        # Create a mapping of date to rating
-        classical_ratings = {datetime(year, month + 1, day).date(): rating for year, month, day, rating in classical_history['points']}
-
-        # Find the last known rating before the 30-day period
-        last_known_rating = None
-        for date in sorted(classical_ratings.keys(), reverse=True):
-            if date < (today - timedelta(days=30)):
-                last_known_rating = classical_ratings[date]
-                break
-
-        # Initialize the last 30 days with -1 to indicate missing rating
-        rating_by_day = {today - timedelta(days=i): -1 for i in range(DAYS_BACK)}
-
-        # Fill the dictionary with the available ratings
-        for rating_date, rating in classical_ratings.items():
-            if rating_date in rating_by_day:
-                rating_by_day[rating_date] = rating
-        
-        # Loop back the other way to fill in the -1s with the last known rating
-        for date in sorted(rating_by_day.keys()):
-            if rating_by_day[date] == -1:
-                rating_by_day[date] = last_known_rating
-            else:
-                last_known_rating = rating_by_day[date]
+        points = _fetch_classical_rating_points(username, deadline)
+        if points is None:
+            return []
         
-        # Convert date keys back to 'today-x' format
-        rating_by_day_formatted = {f"today-{(today - date).days}": rating if rating is not None else "No rating found" 
-                                   for date, rating in rating_by_day.items()}
+        # Bisect straight on the sorted [year, month, day] lists to skip the history before the 30-day period,
+        # so only points inside the window are converted to integer day ordinals (Lichess months are 0-indexed)
+        first_day = TODAY_ORD - DAYS_BACK + 1
+        window_start = date.fromordinal(first_day)
+        i = bisect_left(points, [window_start.year, window_start.month - 1, window_start.day])
+        last_known_rating = points[i - 1][3] if i > 0 else None
+        window_points = [(date(year, month + 1, day).toordinal(), rating) for year, month, day, rating in points[i:]]
 
-        return rating_by_day_formatted
+        # Walk forward through the window carrying the most recent rating
+        j = 0
+        daily_ratings = []
+        for target in range(first_day, TODAY_ORD + 1):
+            while j < len(window_points) and window_points[j][0] <= target:
+                last_known_rating = window_points[j][1]
+                j += 1
+            daily_ratings.append(last_known_rating)
+
+        return daily_ratings
         
     except RequestException as e:
         print(f"An error occurred while making the request: {e}")
     except ValueError:
         print("Error: Failed to parse JSON response.")
 
+    return []
+
+
+def fetch_last_30_day_rating_for_player(username) -> dict:
+    """
+    Fetches the rating history for the top classical chess player for the last 30 days 
+    and returns a dict in format: {username: {today-29: 990, today-28: 991, etc}}
+    """
+    daily_ratings = fetch_daily_ratings_for_player(username)
+    return {f"today-{DAYS_BACK - 1 - offset}": rating if rating is not None else NO_RATING
+            for offset, rating in enumerate(daily_ratings)}
+
     
 # PART 2: Print the rating history for the top chess player in classical chess for the last 30 calendar days.
 # This can be in the format: username, {today-29: 990, today-28: 991, etc}
 def print_last_30_day_rating_for_top_player() -> None:
-    # Get top player
-    players = fetch_top_classical_players(1)
+    # Get top player from the cached top 50 rather than requesting the leaderboard again
+    players = fetch_top_classical_players(50)[:1]
     if not players:
         print("No players found.")
         return
@@ -118,47 +255,54 @@ def print_last_30_day_rating_for_top_player() -> None:
 # The CSV should have 51 rows (1 header, 50 players).
 # The CSV should be in the same order of the leaderboard.
 def generate_rating_csv_for_top_50_classical_players() -> None:
-    players = fetch_top_classical_players()
+    players = fetch_top_classical_players(50)
     if not players:
         print("No players found.")
         return
 
-    # Thread pool to fetch data concurrently for speed
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        # Start the load operations and mark each future with its URL
-        future_to_username = {executor.submit(fetch_last_30_day_rating_for_player, player['username']): player['username'] for player in players}
-        ratings = {}
-        for future in as_completed(future_to_username):
-            username = future_to_username[future]
-            try:
-                player_ratings_raw = future.result()
-                player_ratings = { (today - timedelta(days=int(key.split('-')[1]))).strftime('%Y-%m-%d'): value for key, value in player_ratings_raw.items() }
-                ratings[username] = player_ratings
-            except Exception as e:
-                print(f"{username} generated an exception: {e}")
-                ratings[username] = {}
-
-    # Extract latest ratings for sorting
-    latest_ratings = {
-        username: player_ratings.get(datetime.today().strftime('%Y-%m-%d'), 0)
-        for username, player_ratings in ratings.items()
-    }
-    # Sort by latest rating value in descending order
-    sorted_ratings = sorted(latest_ratings, key=latest_ratings.get, reverse=True)
-
-
-    # Write CSV
-    with open('ratings.csv', 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        # Write the header
-        writer.writerow(['username'] + dates)
-        # Write the player ratings
-        for username in sorted_ratings:
-            # Prepare a list of ratings for each date
-            player_ratings = [ratings[username].get(date, '') for date in dates]
-            writer.writerow([username] + player_ratings)
+    # Give up on stragglers once the rate limiter has admitted every request and CSV_DEADLINE has passed,
+    # so one stalled player can't hold up the whole CSV. Workers get the same deadline so they stop
+    # before sending requests after it, leaving only requests already in flight (bounded by TIMEOUT).
+    timeout = CSV_DEADLINE + len(players) * RATE_LIMITER.per / RATE_LIMITER.rate
+    deadline = time.monotonic() + timeout
+
+    # Thread pool to fetch data concurrently for speed, sized to the rate limiter's burst (see MAX_WORKERS).
+    # Each worker fetches and fills in its player's ratings, so parsing overlaps with the other requests in flight
+    # and the main thread only has to wait for them all.
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    future_by_username = {player['username']: executor.submit(fetch_daily_ratings_for_player, player['username'], deadline)
+                          for player in players}
+    try:
+        done, not_done = wait(future_by_username.values(), timeout=timeout)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    if not_done:
+        print(f"Timed out after {timeout:.0f}s waiting for {len(not_done)} players, leaving them blank.")
+
+    ratings = {}
+    for username, future in future_by_username.items():
+        if future not in done:
+            continue
+        try:
+            ratings[username] = future.result()
+        except Exception as e:
+            print(f"{username} generated an exception: {e}")
+
+    # Build every row in memory, then write the CSV in a single call
+    rows = [['username', *DATES]]
+    # Players are already in leaderboard order from the API, so keep that order.
+    # Players whose ratings couldn't be fetched get a blank row.
+    for player in players:
+        username = player['username']
+        daily_ratings = ratings.get(username)
+        if daily_ratings:
+            rows.append([username, *(rating if rating is not None else NO_RATING for rating in daily_ratings)])
+        else:
+            rows.append([username] + [''] * DAYS_BACK)
+    with open('ratings.csv', 'w', newline='', buffering=1 << 20) as csvfile:
+        csv.writer(csvfile).writerows(rows)
+
 
-    
 def main() -> None:
     print('\n Printing top 50 classical players: \n')
     print_top_50_classical_players()
@@ -167,4 +311,5 @@ def main() -> None:
     print('\n Generating CSV for top 50 classical players: \n')
     generate_rating_csv_for_top_50_classical_players()
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,51 @@
 import unittest
 from unittest.mock import patch, Mock
-from datetime import datetime, date
-from chess import fetch_top_classical_players, fetch_last_30_day_rating_for_player, generate_rating_csv_for_top_50_classical_players
+from datetime import date, timedelta
+import chess
+from chess import fetch_top_classical_players, fetch_last_30_day_rating_for_player, generate_rating_csv_for_top_50_classical_players, RateLimiter
 import csv
+import orjson
+import os
+import tempfile
+import threading
+import time
 from io import StringIO
 
 class TestChessAPI(unittest.TestCase):
 
+    def setUp(self):
+        # Give each test a fresh rate limiter, no retry backoff and empty caches
+        # so tests neither sleep nor depend on requests made by earlier tests
+        for patcher in (patch('chess.RATE_LIMITER', RateLimiter(rate=1000, per=60)),
+                        patch('chess.time.sleep'),
+                        patch.dict(chess._TOP_PLAYERS_CACHE, clear=True),
+                        patch.dict(chess._HISTORY_CACHE, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _generate_csv_bytes(self, players, daily_ratings, fetch=None):
+        """
+        Runs the CSV generator in a temporary directory with the given leaderboard and
+        {username: daily ratings} (or a `fetch` function standing in for fetch_daily_ratings_for_player)
+        and returns the file's contents
+        """
+        if fetch is None:
+            fetch = lambda username, deadline=None: daily_ratings[username]
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                with patch('chess.fetch_top_classical_players', return_value=players), \
+                     patch('chess.fetch_daily_ratings_for_player', side_effect=fetch):
+                    generate_rating_csv_for_top_50_classical_players()
+                with open('ratings.csv', 'rb') as csvfile:
+                    return csvfile.read()
+            finally:
+                os.chdir(cwd)
+
+    def _generate_csv(self, players, daily_ratings, fetch=None):
+        return list(csv.reader(StringIO(self._generate_csv_bytes(players, daily_ratings, fetch).decode(), newline='')))
+
     def test_fetch_top_classical_players(self):
         # Mock response data
         fake_response = {
@@ -28,50 +67,64 @@ class TestChessAPI(unittest.TestCase):
                 {'username': 'player15', 'rating': 1100},
             ]
         }
-        with patch('chess.requests.get') as mock_get:
+        with patch('chess.SESSION.get') as mock_get:
             mock_get.return_value = Mock(ok=True)
-            mock_get.return_value.json.return_value = fake_response
+            mock_get.return_value.content = orjson.dumps(fake_response)
 
             players = fetch_top_classical_players(2)
 
             mock_get.assert_called_with(
-                'https://lichess.org/api/player/top/2/classical')
+                'https://lichess.org/api/player/top/2/classical', timeout=(3.05, 10))
             self.assertEqual(len(players), 2)
             self.assertEqual(players[0]['username'], 'player1') # this checks that the top player is correct
             self.assertEqual(players[1]['username'], 'player2') # this checks that the second player is correct
 
-    @patch('datetime.date')
-    def test_fetch_last_30_day_rating_for_player(self, mock_date):
-        mock_date.today.return_value = date(2023, 10, 7)
-        mock_date.side_effect = lambda *args, **kwargs: date(*args, **kwargs)
+    def test_fetch_top_classical_players_is_cached(self):
+        fake_response = {'users': [{'username': 'player1'}, {'username': 'player2'}, {'username': 'player3'}]}
+        with patch('chess.SESSION.get') as mock_get:
+            mock_get.return_value = Mock(ok=True)
+            mock_get.return_value.content = orjson.dumps(fake_response)
+
+            first = fetch_top_classical_players(3)
+            second = fetch_top_classical_players(3)
 
+            mock_get.assert_called_once() # the leaderboard should only be requested once per run
+            self.assertEqual(first, second)
+
+    def test_fetch_last_30_day_rating_for_player(self):
+        # Pin the 30-day window, which chess computes once at import
+        today = date(2023, 10, 7)
+        dates = tuple((today - timedelta(days=i)).strftime(chess.DATE_FORMAT) for i in range(chess.DAYS_BACK - 1, -1, -1))
+
+        # Lichess months are 0-indexed, so [2023, 8, 1] is 2023-09-01
         fake_rating_response = [{
             'name': 'Classical',
             'points': [
-                [2023, 9, 1, 2400],
-                [2023, 9, 2, 2410],
-                [2023, 9, 3, 2420],
-                [2023, 9, 4, 2430],
-                # 2023, 9, 8 is the last known rating before the 30-day period
-                [2023, 9, 11, 2480],
-                [2023, 9, 12, 2510],
-                [2023, 9, 13, 2520],
-                [2023, 9, 14, 2524],
-                [2023, 9, 16, 2520],
-                [2023, 9, 20, 2520],
-                [2023, 9, 21, 2300],
-                [2023, 9, 22, 2400],
-                [2023, 9, 24, 2510],
-                [2023, 9, 25, 2520],
-                [2023, 9, 26, 2519],
-                [2023, 9, 27, 2522],
-                [2023, 9, 29, 2518],
-                [2023, 10, 3, 2520],
+                [2023, 8, 1, 2400],
+                [2023, 8, 2, 2410],
+                [2023, 8, 3, 2420],
+                [2023, 8, 4, 2430],
+                # 2023-09-04 is the last known rating before the 30-day period
+                [2023, 8, 11, 2480],
+                [2023, 8, 12, 2510],
+                [2023, 8, 13, 2520],
+                [2023, 8, 14, 2524],
+                [2023, 8, 16, 2520],
+                [2023, 8, 20, 2520],
+                [2023, 8, 21, 2300],
+                [2023, 8, 22, 2400],
+                [2023, 8, 24, 2510],
+                [2023, 8, 25, 2520],
+                [2023, 8, 26, 2519],
+                [2023, 8, 27, 2522],
+                [2023, 8, 29, 2518],
+                [2023, 9, 3, 2520],
             ]
         }]
-        with patch('chess.requests.get') as mock_get:
+        with patch.multiple('chess', TODAY=today, TODAY_ORD=today.toordinal(), DATES=dates), \
+             patch('chess.SESSION.get') as mock_get:
             mock_get.return_value = Mock(ok=True)
-            mock_get.return_value.json.return_value = fake_rating_response
+            mock_get.return_value.content = orjson.dumps(fake_rating_response)
 
             ratings = fetch_last_30_day_rating_for_player('mockuser')
 
@@ -80,27 +133,123 @@ class TestChessAPI(unittest.TestCase):
             self.assertEqual(ratings['today-0'], 2520)
             self.assertEqual(ratings['today-1'], 2520)
             self.assertEqual(ratings['today-3'], 2520)
+            self.assertEqual(ratings['today-15'], 2400) # a day with a rating uses that day's rating
+            self.assertEqual(ratings['today-16'], 2300)
+            self.assertEqual(ratings['today-18'], 2520) # days without games carry the last rating forward
             self.assertEqual(ratings['today-30'], 2430) # this checks that we're looking beyond 30 days to fill in the last known rating
 
+    def test_fetch_last_30_day_rating_for_player_without_points(self):
+        fake_rating_response = [{'name': 'Classical', 'points': []}]
+        with patch('chess.SESSION.get') as mock_get:
+            mock_get.return_value = Mock(ok=True)
+            mock_get.return_value.content = orjson.dumps(fake_rating_response)
+
+            ratings = fetch_last_30_day_rating_for_player('newplayer')
+
+            self.assertEqual(len(ratings), chess.DAYS_BACK)
+            self.assertEqual(set(ratings.values()), {chess.NO_RATING})
+
+    def test_csv_marks_days_before_first_rating(self):
+        rows = self._generate_csv([{'username': 'newplayer'}], {'newplayer': [None] * (chess.DAYS_BACK - 1) + [1500]})
+
+        self.assertEqual(rows[1], ['newplayer'] + [chess.NO_RATING] * (chess.DAYS_BACK - 1) + ['1500'])
+
+    def test_rating_history_is_fetched_once_per_player(self):
+        fake_rating_response = [{'name': 'Classical', 'points': [[2023, 9, 1, 2400]]}]
+        with patch('chess.SESSION.get') as mock_get:
+            mock_get.return_value = Mock(ok=True)
+            mock_get.return_value.content = orjson.dumps(fake_rating_response)
+
+            first = fetch_last_30_day_rating_for_player('cacheduser')
+            second = fetch_last_30_day_rating_for_player('cacheduser')
+
+            mock_get.assert_called_once() # the second lookup should be served from the history cache
+            self.assertEqual(first, second)
+
+    def test_error_responses_return_empty_and_are_not_cached(self):
+        with patch('chess.SESSION.get') as mock_get:
+            mock_get.return_value = Mock(ok=False, status_code=429, headers={'Retry-After': '60'})
+
+            self.assertEqual(fetch_top_classical_players(50), [])
+            self.assertEqual(fetch_top_classical_players(50), [])
+            self.assertEqual(fetch_last_30_day_rating_for_player('limiteduser'), {})
+            self.assertEqual(fetch_last_30_day_rating_for_player('limiteduser'), {})
+
+            # each call sends its own requests (with retries) rather than being served from the cache
+            self.assertEqual(mock_get.call_count, 4 * (chess.MAX_RETRIES + 1))
+            self.assertEqual(chess._TOP_PLAYERS_CACHE, {})
+            self.assertEqual(chess._HISTORY_CACHE, {})
+
+    def test_retries_take_a_rate_limiter_token(self):
+        limiter = Mock(rate=1000, per=60, acquire=Mock(return_value=True))
+        rate_limited = Mock(ok=False, status_code=429, headers={'Retry-After': '5'})
+        success = Mock(ok=True, status_code=200, content=orjson.dumps({'users': [{'username': 'player1'}]}))
+        with patch('chess.RATE_LIMITER', limiter), patch('chess.SESSION.get', side_effect=[rate_limited, success]):
+            players = fetch_top_classical_players(1)
+
+        self.assertEqual(players, [{'username': 'player1'}])
+        self.assertEqual(limiter.acquire.call_count, 2) # the retry waited for the limiter too
+        chess.time.sleep.assert_called_once_with(5) # and honoured Retry-After
+
+    def test_no_requests_are_sent_once_the_deadline_passes(self):
+        limiter = RateLimiter(rate=1, per=60)
+        limiter.acquire() # empty the bucket, so the next token is 60s away
+        with patch('chess.RATE_LIMITER', limiter), patch('chess.SESSION.get') as mock_get:
+            ratings = chess.fetch_daily_ratings_for_player('lateplayer', deadline=time.monotonic() + 1)
+
+        self.assertEqual(ratings, [])
+        mock_get.assert_not_called()
+        self.assertNotIn('lateplayer', chess._HISTORY_CACHE)
+
+    def test_csv_leaves_players_past_the_deadline_blank(self):
+        release = threading.Event()
+        self.addCleanup(release.set) # let the stuck worker finish once the test is done
+
+        def fetch(username, deadline=None):
+            if username == 'stuckplayer':
+                release.wait()
+            return [2400] * chess.DAYS_BACK
+
+        players = [{'username': 'player1'}, {'username': 'stuckplayer'}, {'username': 'player3'}]
+        started = time.monotonic()
+        with patch('chess.CSV_DEADLINE', 0.1):
+            rows = self._generate_csv(players, {}, fetch)
+
+        self.assertLess(time.monotonic() - started, 5) # the CSV is written without waiting on the stuck player
+        self.assertEqual([row[0] for row in rows[1:]], ['player1', 'stuckplayer', 'player3'])
+        self.assertEqual(rows[2], ['stuckplayer'] + [''] * chess.DAYS_BACK)
+        self.assertEqual(rows[3], ['player3'] + ['2400'] * chess.DAYS_BACK)
+
+    def test_rate_limiter_waits_once_bucket_is_empty(self):
+        limiter = RateLimiter(rate=2, per=60)
+        with patch('chess.time.sleep') as mock_sleep:
+            with limiter:
+                pass
+            with limiter:
+                pass
+            mock_sleep.assert_not_called() # the first `rate` requests go straight through
+
+            with limiter:
+                pass
+            mock_sleep.assert_called_once()
+            self.assertAlmostEqual(mock_sleep.call_args[0][0], 30, delta=1) # one token refills every per / rate seconds
+
     def test_csv_username_order_matches_leaderboard(self):
-        # Call the function to generate CSV
-        generate_rating_csv_for_top_50_classical_players()
-        
-        # Open the CSV file to read data
-        with open('ratings.csv', newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            # Identify the last two rating date columns
-            columns = reader.fieldnames
-            latest_date = max(columns[1:], key=lambda d: datetime.strptime(d, '%Y-%m-%d'))
-            
-            # Iterate through each player and check if their latest rating is less than or equal to the previous rating
-            prev_rating = None
-            for row in reader:
-                latest_rating = int(row[latest_date])
-                if not prev_rating:
-                    prev_rating = latest_rating
-                self.assertLessEqual(latest_rating, prev_rating, f"Latest rating for {row['username']} is not less than or equal to previous rating")
-                prev_rating = latest_rating
+        # Leaderboard order deliberately doesn't match today's ratings, so a re-sort would be caught
+        players = [{'username': 'player1'}, {'username': 'player2'}, {'username': 'player3'}, {'username': 'player4'}]
+        daily_ratings = {
+            'player1': [2400] * chess.DAYS_BACK,
+            'player2': [2600] * chess.DAYS_BACK,
+            'player3': [], # failed fetch
+            'player4': [2500] * chess.DAYS_BACK,
+        }
+
+        rows = self._generate_csv(players, daily_ratings)
+
+        self.assertEqual(rows[0], ['username', *chess.DATES])
+        self.assertEqual([row[0] for row in rows[1:]], ['player1', 'player2', 'player3', 'player4'])
+        self.assertEqual(rows[3], ['player3'] + [''] * chess.DAYS_BACK) # a failed player still gets a blank row
+        self.assertEqual(rows[2][1:], ['2600'] * chess.DAYS_BACK)
         
 
 if __name__ == '__main__':